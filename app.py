@@ -1,105 +1,248 @@
 import os
 import io
+import socket
 import base64
 import requests
 import logging
 import threading
 import time
 import tarfile
-from flask import Flask, request, jsonify, make_response
+import orjson
+from flask import Flask, Response, request
+from flask_cors import CORS
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 
 # === Flask-приложение ===
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO)
+# 4 MB base64 + запас на JSON-обвязку; Werkzeug отдаёт 413 по Content-Length,
+# не читая тело запроса
+app.config["MAX_CONTENT_LENGTH"] = 5_500_000
+# В продакшене можно выставить LOG_LEVEL=WARNING; неизвестное значение —
+# откат на INFO, а не падение воркера при импорте
+_log_level_name = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_level = getattr(logging, _log_level_name, None)
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+    logger.warning("Unknown LOG_LEVEL %r, falling back to INFO", _log_level_name)
 
 # === Переменные окружения ===
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_HOST = "https://generativelanguage.googleapis.com"
+GEMINI_URL = f"{GEMINI_HOST}/v1beta/models/gemini-2.0-flash:generateContent"
+_GEMINI_URL_WITH_KEY = f"{GEMINI_URL}?key={GEMINI_API_KEY}"
+
+# === HTTP-сессия с пулом соединений ===
+DEFAULT_TIMEOUT = (2.0, 8.0)  # (connect, read)
+
+# TCP keepalive на простаивающих соединениях пула, чтобы NAT и балансировщики
+# не рвали их между запросами
+_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    _SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+
+class KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+_session = requests.Session()
+_session.mount("https://", KeepAliveAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+))
+
+# === Circuit breaker для Gemini ===
+# После 5 отказов подряд (сеть, таймаут, 5xx) запросы к Gemini не делаются
+# 30 секунд — /generate сразу отвечает 503, не занимая воркер. Под локом
+# только чтение и обновление состояния: сам запрос к Gemini идёт без него,
+# иначе gevent-воркер обслуживал бы запросы к Gemini по одному
+class CircuitBreaker:
+    def __init__(self, fail_max, reset_timeout):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # Полуоткрытое состояние: пропускаем один пробный запрос,
+            # остальные ждут ещё reset_timeout или его успеха
+            self._opened_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                self._opened_at = time.monotonic()
+
+_gemini_breaker = CircuitBreaker(fail_max=5, reset_timeout=30)
+
+class GeminiUnavailableError(Exception):
+    pass
+
+def post_to_gemini(body):
+    if not _gemini_breaker.allow():
+        raise GeminiUnavailableError("Circuit breaker is open")
+    try:
+        resp = _session.post(_GEMINI_URL_WITH_KEY, data=body, headers={"Content-Type": "application/json"}, timeout=DEFAULT_TIMEOUT)
+    except requests.RequestException:
+        _gemini_breaker.record_failure()
+        raise
+    if resp.status_code >= 500:
+        _gemini_breaker.record_failure()
+    else:
+        _gemini_breaker.record_success()
+    return resp
+
+# === Валидация base64 ===
+# Стандартный и URL-safe алфавиты — Gemini принимает оба, и ни один символ
+# не требует экранирования в JSON
+_B64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=-_"
 
 # === CORS ===
-def cors_response(payload, status=200):
-    resp = make_response(jsonify(payload), status)
-    resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type"
-    return resp
+# Заголовки и preflight (OPTIONS) обслуживает flask-cors; браузер кэширует
+# preflight на сутки
+CORS(
+    app,
+    origins="*",
+    methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
+    send_wildcard=True
+)
+
+# === JSON-ответы ===
+def json_response(payload, status=200):
+    return Response(orjson.dumps(payload), status, mimetype="application/json")
+
+# Постоянные ответы собираются один раз при импорте и отдаются как есть.
+# Заголовок Allow-Origin всегда "*" (send_wildcard), поэтому объект
+# одинаков для всех клиентов
+_PING_RESPONSE = json_response({"status": "alive"})
+_HOME_RESPONSE = json_response({"status": "✅ Server is running"})
+_MISSING_INPUT_RESPONSE = json_response({"error": "Prompt or image not provided"}, 400)
+
+# === Прогрев соединения с Gemini ===
+def warm_gemini_connection():
+    def warm():
+        try:
+            # DNS, TCP и TLS до первого /generate; соединение остаётся в пуле
+            _session.head(GEMINI_HOST, timeout=3)
+        except Exception as e:
+            logger.warning("Gemini warm-up failed: %s", e)
+    threading.Thread(target=warm, daemon=True).start()
 
 # === Keep-alive для Railway ===
-def start_keep_alive():
+# should_ping вызывается перед каждым пингом; через него gunicorn.conf.py
+# оставляет пинг одному воркеру
+def start_keep_alive(should_ping=None):
+    url = os.getenv("APP_URL")
+    if not url:
+        # Без внешнего адреса пинговать нечего — поток не нужен
+        return
+    ping_url = f"{url}/ping"
+
     def loop():
         while True:
-            url = os.getenv("APP_URL")
-            if url:
+            if should_ping is None or should_ping():
                 try:
-                    requests.get(f"{url}/ping", timeout=5)
+                    _session.head(ping_url, timeout=5)
                     logger.info("⏰ Wakeup ping")
                 except Exception as e:
-                    logger.warning(f"Wakeup failed: {e}")
+                    logger.warning("Wakeup failed: %s", e)
             time.sleep(300)
     threading.Thread(target=loop, daemon=True).start()
 
 # === Роуты ===
 
-@app.route("/ping", methods=["GET", "OPTIONS"])
+@app.errorhandler(413)
+def request_too_large(e):
+    return json_response({"error": "Image size exceeds 4MB"}, 413)
+
+@app.route("/ping", methods=["GET"])
 def ping():
-    if request.method == "OPTIONS":
-        return cors_response({})
-    return cors_response({"status": "alive"})
+    return _PING_RESPONSE
 
-@app.route("/", methods=["GET", "OPTIONS"])
+@app.route("/", methods=["GET"])
 def home():
-    if request.method == "OPTIONS":
-        return cors_response({})
-    return cors_response({"status": "✅ Server is running"})
+    return _HOME_RESPONSE
 
-@app.route("/generate", methods=["POST", "OPTIONS"])
+@app.route("/generate", methods=["POST"])
 def generate_image():
-    if request.method == "OPTIONS":
-        return cors_response({})
-
-    data = request.get_json(silent=True) or {}
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        data = {}
     prompt = data.get("prompt")
     image_b64 = data.get("image_base64")
 
     if not prompt or not image_b64:
-        return cors_response({"error": "Prompt or image not provided"}, 400)
+        return _MISSING_INPUT_RESPONSE
+    if not isinstance(image_b64, str):
+        return json_response({"error": "Invalid image encoding"}, 400)
     if len(image_b64) > 4_000_000:
-        return cors_response({"error": "Image size exceeds 4MB"}, 413)
-
-    payload = {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [
-                    {"text": prompt},
-                    {"inline_data": {
-                        "mime_type": "image/jpeg",
-                        "data": image_b64
-                    }}
-                ]
-            }
-        ]
-    }
+        return json_response({"error": "Image size exceeds 4MB"}, 413)
+
+    if not image_b64.isascii():
+        return json_response({"error": "Invalid image encoding"}, 400)
+    image_bytes = image_b64.encode("ascii")
+    # translate() удаляет все символы алфавита base64 одним проходом в C —
+    # в остатке только посторонние символы
+    rest = image_bytes.translate(None, _B64_ALPHABET)
+    if rest:
+        # Переносы строк (Android Base64.DEFAULT, base64.encodebytes) просто
+        # убираем: в JSON-строку без экранирования они не вставляются
+        if rest.translate(None, b"\r\n"):
+            return json_response({"error": "Invalid image encoding"}, 400)
+        image_bytes = image_bytes.replace(b"\r", b"").replace(b"\n", b"")
+
+    # Тело собирается из готовых байтов: base64 картинки копируется один раз,
+    # без повторной сериализации через json=
+    body = b"".join((
+        b'{"contents":[{"role":"user","parts":[{"text":',
+        orjson.dumps(prompt),
+        b'},{"inline_data":{"mime_type":"image/jpeg","data":"',
+        image_bytes,
+        b'"}}]}]}',
+    ))
 
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-        resp = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=10)
+        resp = post_to_gemini(body)
 
         if resp.status_code != 200:
-            return cors_response({"error": "Gemini API error", "details": resp.text}, resp.status_code)
+            return json_response({"error": "Gemini API error", "details": resp.text}, resp.status_code)
 
-        result = resp.json()
-        text = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+        result = orjson.loads(resp.content)
+        try:
+            text = result["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            text = ""
 
         if not text.strip():
-            return cors_response({"error": "Empty response from Gemini"}, 502)
+            return json_response({"error": "Empty response from Gemini"}, 502)
 
-        return cors_response({"response": text})
+        return json_response({"response": text})
 
+    except GeminiUnavailableError:
+        return json_response({"error": "Gemini API temporarily unavailable"}, 503)
     except Exception as e:
-        logger.error(f"Gemini error: {e}")
-        return cors_response({"error": f"Server error: {e}"}, 500)
-
-if __name__ == "__main__":
-    start_keep_alive()
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+        logger.error("Gemini error: %s", e)
+        return json_response({"error": f"Server error: {e}"}, 500)
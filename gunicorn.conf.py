@@ -0,0 +1,30 @@
+import fcntl
+import os
+import tempfile
+
+# === Хуки gunicorn ===
+
+def post_worker_init(worker):
+    from app import start_keep_alive, warm_gemini_connection
+
+    # У каждого воркера свой пул соединений — прогреваем в каждом
+    warm_gemini_connection()
+
+    # Пинг нужен один на весь сервис: цикл идёт в каждом воркере, но пингует
+    # только тот, кто держит файловую блокировку. Захват пробуется на каждом
+    # круге, поэтому после смерти держателя или перезапуска по HUP (новые
+    # воркеры стартуют, пока старый ещё жив) пинг подхватит любой воркер.
+    # Ядро снимает блокировку, когда процесс-держатель завершается
+    lock_path = os.path.join(tempfile.gettempdir(), f"gemini-proxy-keep-alive-{os.getppid()}.lock")
+    lock_file = open(lock_path, "w")
+    # Держим файл открытым, пока жив воркер
+    worker.keep_alive_lock = lock_file
+
+    def holds_lock():
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    start_keep_alive(should_ping=holds_lock)